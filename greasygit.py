@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
-from urllib.request import urlopen
-from urllib.parse import unquote
+from urllib.request import urlopen, Request
+from urllib.parse import unquote, urlparse, parse_qs
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import calendar
 import re
 import subprocess
-import os
-import shlex
+import time
+import zlib
+from datetime import datetime
+
+try:
+    import lxml.html
+except ImportError:  # lxml is optional; fall back to RegExp when it is missing.
+    lxml = None
+
+try:
+    import requests
+except ImportError:  # requests is optional; fall back to urllib without keep-alive.
+    requests = None
+
+FETCHING_WORKERS = 8
+
+if requests:
+    session = requests.Session()
+    # Let every fetching worker keep its own connection alive.
+    session.mount(
+        "https://", requests.adapters.HTTPAdapter(pool_maxsize=FETCHING_WORKERS)
+    )
+else:
+    session = None
 
 
 def get(url, data=None):
-    with urlopen(url, data) as r:
-        return r.read().decode("utf-8")
+    if session:
+        r = session.request("POST" if data else "GET", url, data=data)
+        r.raise_for_status()
+        return r.content
+    with urlopen(Request(url, data, {"Accept-Encoding": "gzip, deflate"})) as r:
+        content = r.read()
+    if r.headers.get("Content-Encoding") in ("gzip", "deflate"):
+        # With 32 added to wbits, zlib detects both gzip and zlib headers.
+        content = zlib.decompress(content, zlib.MAX_WBITS | 32)
+    return content
+
+
+def parse_html(content):
+    return lxml.html.fromstring(content, parser=lxml.html.HTMLParser(encoding="utf-8"))
 
 
 README_TEMPLATE = """\
@@ -31,8 +67,10 @@ class GreasyForkScript:
     URL_SCRIPT_HOMEPAGE = URL_BASE + "/en/scripts/{id}"
     URL_HISTORY = URL_BASE + "/en/scripts/{id}-{simple_name}/versions{suffix}"
     URL_CODE = URL_BASE + "/scripts/{id}/code/code.js?version={version}"
-    REGEX_METADATA = r"<header>\s*<h2>(?P<name>[^<\n]+)</h2>\s*<p id=\"script-description\"[^>]*>(?P<description>[^<\n]+)</p>"
-    REGEX_LINK_CANONICAL = r'<link rel="canonical" href="(?P<url>[^\"]+)">'
+    REGEX_METADATA = re.compile(
+        r"<header>\s*<h2>(?P<name>[^<\n]+)</h2>\s*<p id=\"script-description\"[^>]*>(?P<description>[^<\n]+)</p>"
+    )
+    REGEX_LINK_CANONICAL = re.compile(r'<link rel="canonical" href="(?P<url>[^\"]+)">')
     REGEX_HISTORY = r"""
         <li>.+?version-number.+? # leading unused content in <li>
             <a[^>]*\ href=\"/en/scripts/{id}[\w\-%+]+\?
@@ -46,17 +84,34 @@ class GreasyForkScript:
 
     def __init__(self, id: int):
         self.id = id
+        self._regex_history = re.compile(
+            self.REGEX_HISTORY.format(id=self.id), re.VERBOSE | re.DOTALL
+        )
         self._load_metadata()
 
     def _load_metadata(self):
         d = get(self.URL_SCRIPT_HOMEPAGE.format(id=self.id))
-        match = re.search(self.REGEX_METADATA, d)
-        self.name = match.group("name")
-        self.description = match.group("description")
-        canon_url = re.search(self.REGEX_LINK_CANONICAL, d).group("url")
-        self.simple_name = unquote(canon_url.split("/")[-1].lstrip(str(self.id) + "-"))
+        if lxml:
+            tree = parse_html(d)
+            self.name = tree.xpath("string(//header/h2)").strip()
+            self.description = tree.xpath(
+                'string(//p[@id="script-description"])'
+            ).strip()
+            canon_url = tree.xpath('//link[@rel="canonical"]/@href')[0]
+        else:
+            d = d.decode("utf-8")
+            match = self.REGEX_METADATA.search(d)
+            self.name = match.group("name")
+            self.description = match.group("description")
+            canon_url = self.REGEX_LINK_CANONICAL.search(d).group("url")
+        simple_name = canon_url.split("/")[-1]
+        prefix = f"{self.id}-"
+        if simple_name.startswith(prefix):
+            simple_name = simple_name[len(prefix) :]
+        self.simple_name = unquote(simple_name)
 
     def get_versions(self, including_all_versions=False):
+        """Get versions of the script, from the oldest to the latest"""
         if including_all_versions:
             url_suffix = "?show_all_versions=1"
         else:
@@ -69,61 +124,205 @@ class GreasyForkScript:
             )
         )
 
-        for version in re.finditer(
-            self.REGEX_HISTORY.format(id=self.id), d, re.VERBOSE | re.DOTALL
-        ):
+        if lxml:
+            versions = list(self._parse_versions(parse_html(d)))
+        else:
+            versions = [
+                Version(
+                    version.group("number"),
+                    version.group("tag"),
+                    version.group("datetime"),
+                    version.group("message"),
+                )
+                for version in self._regex_history.finditer(d.decode("utf-8"))
+            ]
+        # The history page lists the latest version first.
+        versions.reverse()
+        return versions
+
+    @staticmethod
+    def _parse_versions(tree):
+        for li in tree.xpath('//li[.//*[contains(@class, "version-number")]]'):
+            link = li.xpath('.//*[contains(@class, "version-number")]//a[@href]')[0]
+            message = li.xpath('string(.//*[contains(@class, "version-changelog")])')
             yield Version(
-                version.group("number"),
-                version.group("tag"),
-                version.group("datetime"),
-                version.group("message"),
+                parse_qs(urlparse(link.get("href")).query)["version"][0],
+                link.text_content().strip(),
+                li.xpath(".//*[@datetime]/@datetime")[0],
+                message.strip() or None,
             )
 
     def get_code(self, version):
-        code = get(self.URL_CODE.format(id=self.id, version=version))
-        return code
+        return get(self.URL_CODE.format(id=self.id, version=version))
 
 
 def execute_command(command, *args, **kwargs):
-    kwargs["shell"] = True
     return subprocess.check_call(command, *args, **kwargs)
 
 
-def write_file(path, content):
-    with open(path, "wb") as f:
-        return f.write(content.encode("utf-8"))
+def read_command(command, *args, **kwargs):
+    return subprocess.check_output(command, *args, **kwargs).decode("utf-8").strip()
+
+
+REGEX_ISO_DATETIME = re.compile(
+    r"(?P<datetime>\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d)(?:\.\d+)?"
+    r"(?:Z|(?P<sign>[+-])(?P<hours>\d\d):?(?P<minutes>\d\d))?"
+)
 
 
-class GitRepo:
+def to_raw_date(iso_datetime):
+    """Convert an ISO 8601 datetime to the raw date format of git (`<epoch> <tz>`)
+
+    Fractional seconds are dropped and a missing offset is taken as UTC."""
+    match = REGEX_ISO_DATETIME.fullmatch(iso_datetime.strip())
+    if not match:
+        raise ValueError(f"Unrecognized datetime: {iso_datetime!r}")
+    sign, hours, minutes = match.group("sign", "hours", "minutes")
+    if sign is None:
+        sign, hours, minutes = "+", "00", "00"
+    offset = int(hours) * 3600 + int(minutes) * 60
+    if sign == "-":
+        offset = -offset
+    local = datetime.strptime(
+        match.group("datetime").replace(" ", "T"), "%Y-%m-%dT%H:%M:%S"
+    )
+    return "{} {}{}{}".format(
+        calendar.timegm(local.timetuple()) - offset, sign, hours, minutes
+    )
+
+
+def data(content):
+    return b"data %d\n" % len(content) + content + b"\n"
+
+
+class FastImportRepo:
+    """A git repo populated through one long-lived `git fast-import` process"""
+
     def __init__(self, repo_name=None):
         self.path = (repo_name or ".") + "/"
         if repo_name:
-            execute_command(f"git init {repo_name}")
+            execute_command(["git", "init", repo_name])
+        self.ref = read_command(["git", "symbolic-ref", "HEAD"], cwd=self.path)
+        self.author = self._ident("GIT_AUTHOR_IDENT")
+        self.committer = self._ident("GIT_COMMITTER_IDENT")
+        # Continue from the existing tip, if any, instead of starting a new root.
+        self._parent = None
+        returncode = subprocess.call(
+            ["git", "rev-parse", "--quiet", "--verify", self.ref],
+            cwd=self.path,
+            stdout=subprocess.DEVNULL,
+        )
+        if returncode == 0:
+            self._parent = self.ref + "^0"
+        self._tags = set(
+            read_command(
+                ["git", "for-each-ref", "--format=%(refname:strip=2)", "refs/tags/"],
+                cwd=self.path,
+            ).splitlines()
+        )
+        self._process = subprocess.Popen(
+            ["git", "fast-import", "--quiet", "--date-format=raw"],
+            stdin=subprocess.PIPE,
+            cwd=self.path,
+        )
+        # Without the final `done`, an interrupted stream fails instead of updating refs.
+        self._write(b"feature done\n")
+        self._mark = 0
+        self._changes = []
+        self._contents = {}
+        self._last_commit = None
+        self._last_date = None
+
+    def _ident(self, var):
+        # `git var` appends the current date to the name and email, which is not wanted.
+        return read_command(["git", "var", var], cwd=self.path).rsplit(" ", 2)[0]
+
+    def _next_mark(self):
+        self._mark += 1
+        return self._mark
+
+    def _write(self, *chunks):
+        for chunk in chunks:
+            self._process.stdin.write(chunk)
 
     def update_and_add(self, file_path, content):
-        write_file(self.path + file_path, content)
-        self.add(file_path)
-
-    def add(self, file_path):
-        return execute_command(f"git add {file_path}", cwd=self.path)
-
-    def commit(self, message, datetime=None, allowing_empty=False):
-        envs = None
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        # Unchanged content needs no new blob; the commit just keeps the file as is.
+        if self._contents.get(file_path) == content:
+            return
+        self._contents[file_path] = content
+        mark = self._next_mark()
+        self._write(b"blob\nmark :%d\n" % mark, data(content))
+        self._changes.append((file_path, mark))
+
+    def commit(self, message, datetime=None):
+        mark = self._next_mark()
         if datetime:
-            envs = os.environ.copy()
-            envs.update({"GIT_AUTHOR_DATE": datetime, "GIT_COMMITTER_DATE": datetime})
-        command = f"git commit -m {shlex.quote(message)} --allow-empty-message"
-        if allowing_empty:
-            command += " --allow-empty"
-        execute_command(command, cwd=self.path, env=envs)
+            date = to_raw_date(datetime)
+        else:
+            date = "{} {}".format(int(time.time()), time.strftime("%z"))
+        self._write(
+            (
+                f"commit {self.ref}\nmark :{mark}\n"
+                f"author {self.author} {date}\ncommitter {self.committer} {date}\n"
+            ).encode("utf-8"),
+            data((message or "").encode("utf-8")),
+        )
+        if self._parent:
+            self._write(f"from {self._parent}\n".encode("utf-8"))
+            self._parent = None
+        for file_path, blob in self._changes:
+            self._write(f"M 100644 :{blob} {file_path}\n".encode("utf-8"))
+        self._write(b"\n")
+        self._changes = []
+        self._last_commit = mark
+        self._last_date = date
 
     def tag(self, name, message=None, annotated=False):
-        command = f"git tag {name}"
-        if message:
-            command += f" -m {shlex.quote(message)}"
-        if annotated:
-            command += " -a"
-        execute_command(command, cwd=self.path)
+        # Like `git tag`, refuse to move an existing tag.
+        if name in self._tags:
+            raise ValueError(f"Tag already exists: {name!r}")
+        self._tags.add(name)
+        if message or annotated:
+            self._write(
+                (
+                    f"tag {name}\nfrom :{self._last_commit}\n"
+                    f"tagger {self.committer} {self._last_date}\n"
+                ).encode("utf-8"),
+                data((message or "").encode("utf-8")),
+            )
+        else:
+            self._write(
+                f"reset refs/tags/{name}\nfrom :{self._last_commit}\n\n".encode("utf-8")
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        """Finish the import and check out the imported files into the work tree"""
+        self._write(b"done\n")
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, self._process.args)
+        # Only touch the imported files, leaving other local changes in the repo alone.
+        if self._contents:
+            execute_command(
+                ["git", "checkout", "HEAD", "--", *self._contents], cwd=self.path
+            )
+
+    def abort(self):
+        """Stop the import without updating any refs"""
+        self._process.kill()
+        self._process.wait()
 
 
 def main():
@@ -149,25 +348,25 @@ def main():
 
     print("\n⚙️ Initializing git repo...")
 
-    git = GitRepo(repo_name)
-
-    git.update_and_add("README.md", README_TEMPLATE.format(**vars(gfscript)))
-    git.commit("Init with greasygit")
-
-    versions = reversed(list(gfscript.get_versions(including_all_versions)))
-    versions = list(versions)
-    last_tag = None
-    for idx, version in enumerate(versions):
-        print(
-            f"\n⚙️ Processing {version.tag} ({version.number}) at {version.datetime}..."
-        )
-        code = gfscript.get_code(version.number)
-        git.update_and_add(script_file_name, code)
-        git.commit(version.message, version.datetime, including_all_versions)
-        if tagging:
-            if version.tag != last_tag:
-                git.tag(version.tag)
-            last_tag = version.tag
+    with FastImportRepo(repo_name) as git:
+        git.update_and_add("README.md", README_TEMPLATE.format(**vars(gfscript)))
+        git.commit("Init with greasygit")
+
+        versions = gfscript.get_versions(including_all_versions)
+        last_tag = None
+        # Fetch code of versions concurrently ahead of committing them in order.
+        with ThreadPoolExecutor(max_workers=FETCHING_WORKERS) as executor:
+            codes = executor.map(gfscript.get_code, [v.number for v in versions])
+            for idx, (version, code) in enumerate(zip(versions, codes)):
+                print(
+                    f"\n⚙️ Processing {version.tag} ({version.number}) at {version.datetime}..."
+                )
+                git.update_and_add(script_file_name, code)
+                git.commit(version.message, version.datetime)
+                if tagging:
+                    if version.tag != last_tag:
+                        git.tag(version.tag)
+                    last_tag = version.tag
 
     print(f"\n✔️ Done with 1 + {idx + 1} commits.")
     print("ℹ️ Now cd, add a remote and push commits.")